@@ -1,63 +1,224 @@
+import io
 import sys
 import types
-# micropip がない環境向けのスタブ
-sys.modules.setdefault('micropip', types.ModuleType('micropip'))
+# micropip がない環境向けのスタブ (Pyodide/stlite のみ)
+if sys.platform == 'emscripten' and 'micropip' not in sys.modules:
+    sys.modules['micropip'] = types.ModuleType('micropip')
 
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
 import numpy as np
 
+# ──────────── 定数 ────────────
+DIST_COLS = ['走行距離', '一般・実車走行距離']
+TIME_COLS = ['走行時間', 'アイドリング時間', '稼働時間']
+DATE_COLS = ['日付', '運行日']
+STR_COLS = {*TIME_COLS, *DATE_COLS}
+USED_COLS = {'乗務員', *DIST_COLS, *STR_COLS}
+# 走行距離の文字列から数字と小数点以外を取り除く正規表現
+# (re.compile 済みのパターンを渡すと pyarrow の高速経路を外れるため文字列のまま持つ)
+NON_NUMERIC = r'[^0-9.]'
+PREVIEW_COLS = ['走行距離_km', '燃料使用量_L', '燃料費_円', 'アイドリング率_％', '平均速度_km_h']
+# 明細行は丸めずに保持し、表示する時点で一度だけ丸める
+PREVIEW_ROUND = {
+    '走行距離_km': 2, '燃料使用量_L': 2, '燃料費_円': 0, 'アイドリング率_％': 2, '平均速度_km_h': 2
+}
+SUMMARY_ROUND = {
+    '走行距離_km': 2, '燃料使用量_L': 2, '燃料費_円': 0,
+    '月間平均燃費_km_L': 2, '月間アイドリング率_％': 2
+}
+# Figure はプロセス内の全セッションで共有されるため、保持する数に上限を設ける
+FIGURE_CACHE_ENTRIES = 64
+
 # ──────────── ユーティリティ ────────────
-def convert_time_to_minutes(time_str):
+def parse_time_minutes(value):
+    # 1 件ずつの変換 (全角数字や前後の空白など、timedelta パーサが読めない値の救済用)
     try:
-        parts = list(map(int, str(time_str).split(':')))
-        if len(parts) == 3:
-            h, m, s = parts
-            return h * 60 + m + s / 60
-        elif len(parts) == 2:
-            h, m = parts
-            return h * 60 + m
-    except:
-        pass
-    return pd.NA
+        parts = list(map(int, str(value).split(':')))
+    except ValueError:
+        return np.nan
+    if len(parts) == 3:
+        h, m, s = parts
+        return h * 60 + m + s / 60
+    if len(parts) == 2:
+        h, m = parts
+        return h * 60 + m
+    return np.nan
+
+def convert_time_to_minutes(series):
+    # 同じ時刻文字列は何度も現れるため、ユニーク値だけを変換して各行へ展開する
+    # 半角数字だけの "時:分" / "時:分:秒" を pandas の timedelta パーサで一括変換する
+    # ("時:分" は ":00" を補って "時:分:秒" に揃える。それ以外の値は NaN にして下のパーサへ回す)
+    # (各桁数は 6 桁までに制限し、timedelta64[ns] で桁あふれする値も下のパーサへ回す)
+    codes, uniques = pd.factorize(series)
+    raw = pd.Series(uniques).astype(str)
+    plain = raw.str.fullmatch(r'[0-9]{1,6}(?::[0-9]{1,6}){1,2}')
+    text = raw.mask(raw.str.count(':') == 1, raw + ':00').where(plain)
+    minutes = pd.to_timedelta(text, errors='coerce').dt.total_seconds().to_numpy() / 60
+    # 読めなかった値だけ 1 件ずつのパーサに回す
+    failed = np.isnan(minutes)
+    if failed.any():
+        minutes[failed] = np.fromiter(
+            map(parse_time_minutes, raw.to_numpy()[failed]), dtype=np.float64, count=failed.sum()
+        )
+    # 欠損値 (code = -1) は末尾に追加した NaN を参照させる
+    return pd.Series(np.append(minutes, np.nan)[codes], index=series.index)
+
+def divide_or_nan(numerator, denominator, scale=1):
+    # 分母が 0 以下・欠損の要素は除算せず NaN のまま残す (ndarray 上で一括計算)
+    num = np.asarray(numerator, dtype=np.float64)
+    den = np.asarray(denominator, dtype=np.float64)
+    out = np.full(den.shape, np.nan)
+    np.divide(num, den, out=out, where=den > 0)
+    if scale != 1:
+        out *= scale
+    return out
 
 # ──────────── データ処理関数 ────────────
-def process_csv_data(df, fuel_price, fuel_efficiency, date_col=None):
-    # 走行距離の数値化
-    df['走行距離'] = df['走行距離'].astype(str).str.replace(r'[^0-9\.]', '', regex=True)
-    df['走行距離_km'] = pd.to_numeric(df['走行距離'], errors='coerce')
-    df = df.dropna(subset=['走行距離_km'])
+@st.cache_data
+def load_csv_data(file_bytes):
+    # 燃料単価・想定燃費に依存しない前処理 (アップロードファイル単位でキャッシュ)
+
+    # 元データ読み込み (ヘッダーを先に読み、使用する列だけを pyarrow エンジンで読み込む)
+    # (アップロード済みのバイト列をそのまま渡し、cp932 の変換は pyarrow に任せる)
+    buf = io.BytesIO(file_bytes)
+    header = pd.read_csv(buf, encoding='cp932', nrows=0).columns
+    buf.seek(0)
+
+    # 列名マッピング (ヘッダーを一度だけ走査して使用列を絞り、その中から走行距離列を決める)
+    # (列の有無は frozenset で判定する。時間列の判定にも使う)
+    usecols = [c for c in header if c in USED_COLS]
+    present = frozenset(usecols)
+    dist_col = next((c for c in DIST_COLS if c in present), None)
+    if dist_col is None:
+        raise Exception(f"走行距離列が見つかりません: {header.tolist()}")
+    if '乗務員' not in present:
+        raise Exception("'乗務員' 列が見つかりません。CSVに '乗務員' 列を含めてください。")
+    usecols = [c for c in usecols if c not in DIST_COLS or c == dist_col]
+
+    # 時間・日付列は pyarrow に time/date 型へ推論させず文字列のまま読み、
+    # 乗務員は読み込み時に辞書エンコードしてカテゴリ型にする
+    dtype = {c: str for c in usecols if c in STR_COLS}
+    dtype['乗務員'] = 'category'
+    try:
+        df = pd.read_csv(buf, encoding='cp932', engine='pyarrow', usecols=usecols, dtype=dtype)
+    except pd.errors.ParserError:
+        # pyarrow は列数の足りない行 (末尾の合計行など) を読めないため、C エンジンで読み直す
+        buf.seek(0)
+        df = pd.read_csv(buf, encoding='cp932', usecols=usecols, dtype=dtype)
+    df = df.rename(columns={dist_col: '走行距離'})
 
+    # 走行距離の数値化 (数値として読めていれば文字列の除去処理は省く)
+    # 数値にならない行はここで一度だけ除外
+    dist = df['走行距離']
+    if pd.api.types.is_numeric_dtype(dist):
+        dist_km = dist.astype('float64')
+    else:
+        # 文字列の除去は重複を除いた値にだけ行い、コードで全行へ展開する
+        codes, uniques = pd.factorize(dist)
+        km = pd.to_numeric(
+            pd.Series(uniques).astype(str).str.replace(NON_NUMERIC, '', regex=True),
+            errors='coerce'
+        ).to_numpy(dtype=float, na_value=np.nan)
+        dist_km = pd.Series(np.append(km, np.nan)[codes], index=dist.index)
+    valid = dist_km.notna()
+    df = df.loc[valid]
+
+    # 派生列は ndarray のまま計算し、最後に一度の assign でまとめて追加する
+    km = dist_km[valid].to_numpy()
+    # (列がない場合も pd.NA ではなく NaN の float64 配列にして数値計算を保つ)
+    minutes = {
+        col: convert_time_to_minutes(df[col]).to_numpy() if col in present
+        else np.full(len(df), np.nan)
+        for col in TIME_COLS
+    }
+    df = df.assign(**{
+        '走行距離_km': km,
+        **{f'{col}_分': values for col, values in minutes.items()},
+        # アイドリング率 (アイドリング時間 ÷ 稼働時間)
+        'アイドリング率_％': divide_or_nan(minutes['アイドリング時間'], minutes['稼働時間'], 100),
+        # 平均速度 (走行距離 ÷ 走行時間)
+        '平均速度_km_h': divide_or_nan(km, minutes['走行時間'], 60),
+    })
+
+    # 日付列変換 (アップロードごとに一度だけ。同じ日付文字列は cache で使い回す)
+    date_col = next((c for c in DATE_COLS if c in present), None)
+    if date_col:
+        df['運行日'] = pd.to_datetime(df[date_col], errors='coerce', cache=True)
+
+    return df
+
+def process_csv_data(df, fuel_price, fuel_efficiency):
     # 燃料使用量と費用
-    df['燃料使用量_L'] = (df['走行距離_km'] / fuel_efficiency).round(2)
-    df['燃料費_円'] = (df['燃料使用量_L'] * fuel_price).round(0)
-
-    # 時間列を分に変換
-    for col in ['走行時間', 'アイドリング時間', '稼働時間']:
-        df[f'{col}_分'] = df[col].apply(convert_time_to_minutes) if col in df.columns else pd.NA
-
-    # アイドリング率 (アイドリング時間 ÷ 稼働時間)
-    valid_active = df['稼働時間_分'] > 0
-    df['アイドリング率_％'] = np.where(
-        valid_active,
-        (df['アイドリング時間_分'] / df['稼働時間_分'] * 100).round(2),
-        pd.NA
-    )
+    df['燃料使用量_L'] = df['走行距離_km'] / fuel_efficiency
+    df['燃料費_円'] = df['燃料使用量_L'] * fuel_price
+
+    return df
 
-    # 平均速度 (走行距離 ÷ 走行時間)
-    valid_drive = df['走行時間_分'] > 0
-    df['平均速度_km_h'] = np.where(
-        valid_drive,
-        (df['走行距離_km'] / (df['走行時間_分'] / 60)).round(2),
-        pd.NA
+@st.cache_data
+def summarize(file_bytes, fuel_price, fuel_efficiency, _df):
+    # 月間ドライバー別集計 (閾値スライダー操作では再集計しない)
+    # (キャッシュキーは DataFrame ではなく元のバイト列と単価・燃費にする。
+    #  大きな DataFrame は標本行だけでハッシュされ、中身が変わっても古い集計が返るため。
+    #  集計対象は同じ再実行で処理済みの _df をハッシュせずに受け取る)
+    summary = _df.groupby('乗務員', as_index=False, observed=True, sort=False).agg(
+        走行距離_km=('走行距離_km', 'sum'),
+        燃料使用量_L=('燃料使用量_L', 'sum'),
+        燃料費_円=('燃料費_円', 'sum'),
+        稼働時間_分=('稼働時間_分', 'sum'),
+        アイドリング時間_分=('アイドリング時間_分', 'sum'),
+        走行時間_分=('走行時間_分', 'sum')
     )
+    summary = summary.assign(**{
+        '月間平均燃費_km_L': divide_or_nan(summary['走行距離_km'], summary['燃料使用量_L']),
+        '月間アイドリング率_％': divide_or_nan(
+            summary['アイドリング時間_分'], summary['稼働時間_分'], 100
+        ),
+    })
 
-    # 日付列変換
-    if date_col and date_col in df.columns:
-        df['運行日'] = pd.to_datetime(df[date_col], errors='coerce')
+    # 丸めは表示・グラフ用に集計後の小さな表でまとめて行う
+    return summary.round(SUMMARY_ROUND)
 
-    return df
+# ──────────── グラフ ────────────
+@st.cache_data
+def rank_summary(summary, y):
+    # 降順のランキングビュー (集計が変わらない限りスライダー操作では再ソートしない)
+    # NaN は -inf として末尾へ、同値は集計順のまま並べる
+    values = summary[y].to_numpy(dtype=float, na_value=np.nan)
+    order = np.argsort(-np.nan_to_num(values, nan=-np.inf), kind='stable')
+    return summary.iloc[order]
+
+def ranking_bar(ranked, y, title, **bar):
+    # DataFrame を介さず ndarray だけで棒グラフを組み立てる
+    fig = go.Figure(go.Bar(x=ranked['乗務員'].to_numpy(), y=ranked[y].to_numpy(), **bar))
+    fig.update_layout(title=title, xaxis_title='乗務員', yaxis_title=y, xaxis_tickangle=-45)
+    return fig
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+def bar_figure(summary, y, title):
+    # Plotly の Figure 生成は集計・列・タイトルが変わったときだけ行う
+    return ranking_bar(rank_summary(summary, y), y, title)
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+def idling_figure(summary, idling_threshold):
+    # 閾値で色分けしたアイドリング率ランキング (閾値ごとにキャッシュ)
+    y = '月間アイドリング率_％'
+    ranked = rank_summary(summary, y)
+    idling_rate = ranked[y].to_numpy(dtype=float, na_value=np.nan)
+    fig = ranking_bar(
+        ranked, y, f'ドライバー別 月間アイドリング率 (%) (閾値: {idling_threshold}%)',
+        marker_color=np.where(idling_rate >= idling_threshold, 'red', 'blue')
+    )
+    fig.add_shape(
+        type='line', x0=-0.5, x1=len(summary) - 0.5,
+        y0=idling_threshold, y1=idling_threshold,
+        line=dict(color='black', dash='dash')
+    )
+    return fig
+
+def plot_bar(df, y, title):
+    st.plotly_chart(bar_figure(df, y, title), use_container_width=True)
 
 # ──────────── Streamlit UI ────────────
 st.set_page_config(page_title='燃費見える化ダッシュボード', layout='wide')
@@ -77,71 +238,30 @@ idling_threshold = col3.slider('アイドリング率警告閾値 (%)', 0, 100,
 uploaded_file = st.file_uploader('CSV アップロード (cp932)', type=['csv'])
 if uploaded_file:
     try:
-        # 元データ読み込み
-        df_raw = pd.read_csv(uploaded_file, encoding='cp932')
-        df_raw = df_raw.T.drop_duplicates(keep='first').T
-
-        # 列名マッピング
-        if '走行距離' in df_raw.columns:
-            dist_col = '走行距離'
-        elif '一般・実車走行距離' in df_raw.columns:
-            dist_col = '一般・実車走行距離'
-        else:
-            raise Exception(f"走行距離列が見つかりません: {df_raw.columns.tolist()}")
-        rename_map = {dist_col: '走行距離'}
-        for key in ['アイドリング時間', '稼働時間', '日付', '運行日']:
-            if key in df_raw.columns:
-                rename_map[key] = key
-        df = df_raw.rename(columns=rename_map)
-        df = df.loc[:, ~df.columns.duplicated()]
-
-        if '乗務員' not in df.columns:
-            raise Exception("'乗務員' 列が見つかりません。CSVに '乗務員' 列を含めてください。")
+        # 元データ読み込み (キャッシュ済み)
+        file_bytes = uploaded_file.getvalue()
+        df = load_csv_data(file_bytes)
 
         # 日付列決定
-        date_col = '日付' if '日付' in df.columns else '運行日' if '運行日' in df.columns else None
+        date_col = next((c for c in DATE_COLS if c in df.columns), None)
 
         # データ処理
-        df = process_csv_data(df, fuel_price, fuel_efficiency, date_col)
+        df = process_csv_data(df, fuel_price, fuel_efficiency)
         st.success('✅ データ読み込み完了')
 
         # データプレビュー
         st.subheader('🔍 データプレビュー')
-        preview_cols = ['乗務員'] + ([date_col] if date_col else []) + [
-            '走行距離_km', '燃料使用量_L', '燃料費_円', 'アイドリング率_％', '平均速度_km_h'
-        ]
-        st.dataframe(df[preview_cols])
+        preview_cols = ['乗務員'] + ([date_col] if date_col else []) + PREVIEW_COLS
+        st.dataframe(df[preview_cols].round(PREVIEW_ROUND))
 
         # 月間ドライバー別集計
-        summary = df.groupby('乗務員', as_index=False).agg(
-            走行距離_km=('走行距離_km', 'sum'),
-            燃料使用量_L=('燃料使用量_L', 'sum'),
-            燃料費_円=('燃料費_円', 'sum'),
-            稼働時間_分=('稼働時間_分', 'sum'),
-            アイドリング時間_分=('アイドリング時間_分', 'sum'),
-            走行時間_分=('走行時間_分', 'sum')
-        )
-        summary['月間平均燃費_km_L'] = np.where(
-            summary['燃料使用量_L'] > 0,
-            (summary['走行距離_km'] / summary['燃料使用量_L']).round(2),
-            pd.NA
-        )
-        summary['月間アイドリング率_％'] = np.where(
-            summary['稼働時間_分'] > 0,
-            (summary['アイドリング時間_分'] / summary['稼働時間_分'] * 100).round(2),
-            pd.NA
-        )
+        summary = summarize(file_bytes, fuel_price, fuel_efficiency, df)
 
         # 月間集計表示
         st.subheader('📅 月間ドライバー別集計')
         st.dataframe(summary)
 
         # 各ランキンググラフ
-        def plot_bar(df, y, title):
-            fig = px.bar(df.sort_values(y, ascending=False), x='乗務員', y=y, title=title)
-            fig.update_layout(xaxis_tickangle=-45)
-            st.plotly_chart(fig, use_container_width=True)
-
         st.subheader('📊 月間燃料使用量ランキング')
         plot_bar(summary, '燃料使用量_L', 'ドライバー別 月間燃料使用量 (L)')
 
@@ -149,23 +269,8 @@ if uploaded_file:
         plot_bar(summary, '燃料費_円', 'ドライバー別 月間燃料費 (円)')
 
         # アイドリング率ランキング
-        summary['アイドリング色'] = np.where(
-            summary['月間アイドリング率_％'] >= idling_threshold, 'red', 'blue'
-        )
         st.subheader('📊 月間アイドリング率ランキング')
-        fig2 = px.bar(
-            summary.sort_values('月間アイドリング率_％', ascending=False),
-            x='乗務員', y='月間アイドリング率_％',
-            color='アイドリング色', color_discrete_map={'red': 'red', 'blue': 'blue'},
-            title=f'ドライバー別 月間アイドリング率 (%) (閾値: {idling_threshold}%)'
-        )
-        fig2.add_shape(
-            type='line', x0=-0.5, x1=len(summary) - 0.5,
-            y0=idling_threshold, y1=idling_threshold,
-            line=dict(color='black', dash='dash')
-        )
-        fig2.update_layout(xaxis_tickangle=-45, showlegend=False)
-        st.plotly_chart(fig2, use_container_width=True)
+        st.plotly_chart(idling_figure(summary, idling_threshold), use_container_width=True)
 
         # 算出式表示
         st.markdown('**算出式**')
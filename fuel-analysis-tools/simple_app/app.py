@@ -1,24 +1,64 @@
+import io
+
 import streamlit as st
 import pandas as pd
+import numpy as np
+
+TIME_COLS = ["ハンドル時間－時分－", "アイドリング－時分－"]
+SOURCE_COLS = ["乗務員", "運行日", "走行距離－ｋｍ－", *TIME_COLS]
+OUTPUT_COLS = [
+    "乗務員", "運行日", "走行距離_km", "運転時間_分", "アイドリング時間_分",
+    "アイドリング率_％", "平均速度_km_per_h", "燃料使用量_L", "燃料費_円",
+]
+OUTPUT_ROUND = {"アイドリング率_％": 2, "平均速度_km_per_h": 2, "燃料使用量_L": 2, "燃料費_円": 0}
+FUEL_EFFICIENCY = 3.5
 
-def convert_time_to_minutes(time_str):
+def parse_time_minutes(value):
+    # 1 件ずつの "時:分" 変換 (全角数字・符号・空白など、一括変換で扱わない値用。読めない値は 0)
     try:
-        hours, minutes = map(int, str(time_str).split(":"))
+        hours, minutes = map(int, str(value).split(":"))
         return hours * 60 + minutes
-    except:
+    except ValueError:
         return 0
 
-def process_csv_data(uploaded_file, fuel_price):
-    df = pd.read_csv(uploaded_file, encoding="cp932")
-    df["運転時間_分"] = df["ハンドル時間－時分－"].apply(convert_time_to_minutes)
-    df["アイドリング時間_分"] = df["アイドリング－時分－"].apply(convert_time_to_minutes)
+def convert_time_to_minutes(series):
+    # "時:分" を列単位でまとめて分に変換 (読めない値は 0)
+    # 重複を除いた値のうち、半角数字だけの "時:分" は一括で計算し、残りは 1 件ずつ int() で読む
+    codes, uniques = pd.factorize(series.astype(str))
+    text = pd.Series(uniques, dtype=object)
+    parts = text.str.extract(r"^([0-9]{1,9}):([0-9]{1,9})$")
+    fast = parts[0].notna().to_numpy()
+    minutes = np.zeros(len(text), dtype=np.int64)
+    minutes[fast] = parts[0][fast].astype(int) * 60 + parts[1][fast].astype(int)
+    minutes[~fast] = np.fromiter(
+        map(parse_time_minutes, text[~fast]), dtype=np.int64, count=(~fast).sum()
+    )
+    # 欠損値 (code = -1) は末尾に追加した 0 を参照させる
+    return pd.Series(np.append(minutes, 0)[codes], index=series.index)
+
+@st.cache_data
+def load_csv_data(file_bytes):
+    # 燃料単価に依存しない前処理 (アップロードファイル単位でキャッシュ)
+    # 使う列だけを pyarrow エンジンで読む (時刻・日付は文字列のまま)
+    options = dict(
+        encoding="cp932", usecols=SOURCE_COLS, dtype={c: str for c in ["運行日", *TIME_COLS]}
+    )
+    try:
+        df = pd.read_csv(io.BytesIO(file_bytes), engine="pyarrow", **options)
+    except pd.errors.ParserError:
+        # pyarrow は列数の足りない行 (末尾の合計行など) を読めないため、C エンジンで読み直す
+        df = pd.read_csv(io.BytesIO(file_bytes), **options)
+    df["運転時間_分"] = convert_time_to_minutes(df["ハンドル時間－時分－"])
+    df["アイドリング時間_分"] = convert_time_to_minutes(df["アイドリング－時分－"])
     df["走行距離_km"] = pd.to_numeric(df["走行距離－ｋｍ－"], errors="coerce")
-    df["アイドリング率_％"] = (df["アイドリング時間_分"] / df["運転時間_分"] * 100).round(2)
-    df["平均速度_km_per_h"] = (df["走行距離_km"] / (df["運転時間_分"] / 60)).round(2)
-    fuel_efficiency = 3.5
-    df["燃料使用量_L"] = (df["走行距離_km"] / fuel_efficiency).round(2)
-    df["燃料費_円"] = (df["燃料使用量_L"] * fuel_price).round(0)
-    return df[[ "乗務員", "運行日", "走行距離_km", "運転時間_分", "アイドリング時間_分", "アイドリング率_％", "平均速度_km_per_h", "燃料使用量_L", "燃料費_円" ]]
+    df["アイドリング率_％"] = df["アイドリング時間_分"] / df["運転時間_分"] * 100
+    df["平均速度_km_per_h"] = df["走行距離_km"] / (df["運転時間_分"] / 60)
+    df["燃料使用量_L"] = df["走行距離_km"] / FUEL_EFFICIENCY
+    return df
+
+def process_csv_data(df, fuel_price):
+    df["燃料費_円"] = df["燃料使用量_L"] * fuel_price
+    return df[OUTPUT_COLS].round(OUTPUT_ROUND)
 
 def main():
     st.title("🚚 燃費見える化くん（簡易版）")
@@ -26,7 +66,7 @@ def main():
     uploaded_file = st.file_uploader("CSVファイルを選んでください", type=["csv"])
     if uploaded_file:
         try:
-            df = process_csv_data(uploaded_file, fuel_price)
+            df = process_csv_data(load_csv_data(uploaded_file.getvalue()), fuel_price)
             st.dataframe(df)
         except Exception as e:
             st.error(f"エラーが発生しました: {e}")